@@ -1,12 +1,18 @@
 ### MTA Bus Stops and Routes Mapping from multiple GTFS feeds (All Boroughs)
 
-import os, glob, io, zipfile, webbrowser
+import io, json, gzip, hashlib, zipfile, webbrowser
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-from shapely.geometry import LineString, Point
+import shapely
+import pyarrow as pa
+from pyarrow import csv as pa_csv
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import folium
 from folium.plugins import MarkerCluster
+from branca.element import MacroElement
+from jinja2 import Template
 
 # If any packages or modules are missing, do pip install packagename 
 # (Ex: pip install geopandas) in any cell or in Bash/PowerShell
@@ -16,162 +22,308 @@ from folium.plugins import MarkerCluster
 FOLDER = Path("./bus_gtfs")  # or change to another working path
 print("FOLDER exists?", FOLDER.exists())
 
+# Set the pattern of the zipped filenames
+ZIP_PATTERN = "gtfs_*.zip"
+
 ### Verify the paths found in FOLDER
-zip_paths = sorted(FOLDER.glob("gtfs_*.zip"))
+zip_paths = sorted(FOLDER.glob(ZIP_PATTERN))
 print("Found:", [p.name for p in zip_paths])
-assert zip_paths, f"No GTFS zips found in {FOLDER}/gtfs_*.zip"
+assert zip_paths, f"No GTFS zips found in {FOLDER}/{ZIP_PATTERN}"
 
-# Set the pattern of the zipped filenames
-ZIP_PATTERN = "gtfs_*.zip"
-REQUIRED_FILES = ["shapes.txt", "stops.txt", "routes.txt", "trips.txt"]
-buckets = {k: [] for k in REQUIRED_FILES}
+# Set to False for a stops-only map: shapes/trips/routes are then never read
+# (shapes.txt is by far the largest file in each feed)
+DRAW_ROUTES = True
+REQUIRED_FILES = ["stops.txt"]
+if DRAW_ROUTES:
+    REQUIRED_FILES += ["shapes.txt", "routes.txt", "trips.txt"]
 
-zips = sorted(glob.glob(os.path.join(FOLDER, ZIP_PATTERN)))
-assert zips, f"No GTFS zips found in {FOLDER}/{ZIP_PATTERN}"
+# Set to True to only show stops lying on (within ~10 m of) the drawn routes,
+# e.g. together with the route filter further below
+STOPS_NEAR_ROUTES_ONLY = False
 
-for zp in zips:
-    feed_name = os.path.splitext(os.path.basename(zp))[0]  # e.g., 'gtfs_m'
+# Columns read from each GTFS file and their types, handed to the pyarrow
+# parser itself so ids are read as text as-is (e.g. "007" stays "007");
+# float32 keeps ~1 m precision on lat/lon, plenty for a web map
+GTFS_COLUMNS = {
+    "shapes.txt": {"shape_id": pa.string(), "shape_pt_lat": pa.float32(), "shape_pt_lon": pa.float32(),
+                   "shape_pt_sequence": pa.int32()},
+    "stops.txt":  {"stop_id": pa.string(), "stop_name": pa.string(),
+                   "stop_lat": pa.float32(), "stop_lon": pa.float32()},
+    "routes.txt": {"route_id": pa.string(), "route_short_name": pa.string(),
+                   "route_long_name": pa.string(), "route_color": pa.string()},
+    "trips.txt":  {"route_id": pa.string(), "shape_id": pa.string()},
+}
+
+# Parsed tables are cached as parquet, keyed by the zips' names, sizes and
+# modification times (and the column schema), so repeat runs skip the zips
+CACHE_DIR = FOLDER / ".gtfs_cache"
+cache_key = "".join(f"{p.name}:{p.stat().st_mtime_ns}:{p.stat().st_size};" for p in zip_paths)
+sig = hashlib.sha1((cache_key + repr(GTFS_COLUMNS)).encode()).hexdigest()[:12]
+cache_paths = {fn: CACHE_DIR / f"{sig}_{Path(fn).stem}.parquet" for fn in REQUIRED_FILES}
+
+def load_zip(zp):
+    # parse the required files of one GTFS zip -> {filename: DataFrame}
+    feed_name = zp.stem  # e.g., 'gtfs_m'
+    out = {}
     with zipfile.ZipFile(zp) as z:
         names = set(z.namelist())
         for fn in REQUIRED_FILES:
             if fn in names:
-                df = pd.read_csv(z.open(fn), dtype=str, low_memory=False)
+                # read the whole member up front so the parser works on one
+                # in-memory buffer instead of pulling from the zip stream
+                # (empty strings become missing values, as with pd.read_csv;
+                # optional columns a feed leaves out come back all-null)
+                df = pa_csv.read_csv(
+                    io.BytesIO(z.read(fn)),
+                    convert_options=pa_csv.ConvertOptions(
+                        include_columns=list(GTFS_COLUMNS[fn]),
+                        include_missing_columns=True,
+                        column_types=GTFS_COLUMNS[fn],
+                        strings_can_be_null=True,
+                    ),
+                ).to_pandas()
                 df["borough_feed"] = feed_name
-                buckets[fn].append(df)
+                out[fn] = df
             else:
                 print(f"[WARN] {fn} missing in {feed_name}")
+    return out
 
+if all(p.exists() for p in cache_paths.values()):
+    print("Using cached GTFS tables in", CACHE_DIR)
+    tables = {fn: pd.read_parquet(p) for fn, p in cache_paths.items()}
+else:
+    # the zips are independent, so decompress and parse them in parallel
+    buckets = {k: [] for k in REQUIRED_FILES}
+    with ThreadPoolExecutor(max_workers=len(zip_paths)) as ex:
+        for feed in ex.map(load_zip, zip_paths):
+            for fn, df in feed.items():
+                buckets[fn].append(df)
 
-# concat and normalize dtypes
-shapes = pd.concat(buckets["shapes.txt"], ignore_index=True)
-stops  = pd.concat(buckets["stops.txt"],  ignore_index=True)
-routes = pd.concat(buckets["routes.txt"], ignore_index=True)
-trips  = pd.concat(buckets["trips.txt"],  ignore_index=True)
+    # concat (dtypes were already set while parsing)
+    tables = {fn: pd.concat(buckets[fn], ignore_index=True) for fn in REQUIRED_FILES}
+    # each file is written under a temporary name and renamed into place, so an
+    # interrupted run never leaves a truncated cache behind; caches of older
+    # versions of the feeds are removed
+    CACHE_DIR.mkdir(exist_ok=True)
+    for fn, df in tables.items():
+        tmp = cache_paths[fn].with_name(cache_paths[fn].name + ".tmp")
+        df.to_parquet(tmp, index=False)
+        tmp.replace(cache_paths[fn])
+    for p in CACHE_DIR.iterdir():
+        if not p.name.startswith(f"{sig}_"):
+            p.unlink()
 
-# cast numeric columns
-for col in ["shape_pt_lat", "shape_pt_lon"]:
-    shapes[col] = shapes[col].astype(float)
-shapes["shape_pt_sequence"] = shapes["shape_pt_sequence"].astype(int)
 
-stops["stop_lat"] = stops["stop_lat"].astype(float)
-stops["stop_lon"] = stops["stop_lon"].astype(float)
+stops = tables["stops.txt"]
 
-# make a collision-proof shape key (shape_id can repeat across feeds)
-shapes["shape_uid"] = shapes["borough_feed"] + "_" + shapes["shape_id"]
+# the same stop is listed by more than one feed; keep one row per
+# (stop_id, lat, lon), compared through a single 64-bit row hash
+stop_key = pd.util.hash_pandas_object(stops[["stop_id", "stop_lat", "stop_lon"]], index=False)
+stops = stops.loc[~stop_key.duplicated()]
 
-# Mapping for shapes and route labels (short/long name)
-# Merge trips to routes
-shape2route = (
-    trips[["route_id", "shape_id", "borough_feed"]].dropna()
-    .drop_duplicates(["shape_id", "borough_feed"])
-    .merge(
-        routes[["route_id", "route_short_name", "route_long_name", "route_color", "borough_feed"]],
-        on=["route_id", "borough_feed"], how="left"
-    )
-)
-shape2route["shape_uid"] = shape2route["borough_feed"] + "_" + shape2route["shape_id"]
-
-# build LineStrings per shapes (shape_uid)
-shapes_sorted = shapes.sort_values(["shape_uid", "shape_pt_sequence"])
-lines = (
-    shapes_sorted
-      .groupby("shape_uid")[["shape_pt_lon", "shape_pt_lat"]]
-      .apply(lambda df: LineString(df.to_numpy()))
-      .to_frame("geometry")
-      .reset_index()
+# Get stops GeoDataFrame (keep borough_feed to avoid ID ambiguity)
+# (stops without usable coordinates are dropped)
+stop_lon = stops["stop_lon"].to_numpy()
+stop_lat = stops["stop_lat"].to_numpy()
+has_coords = np.isfinite(stop_lon) & np.isfinite(stop_lat)
+stops_gdf = gpd.GeoDataFrame(
+    stops.loc[has_coords, ["stop_id", "stop_name", "stop_lat", "stop_lon", "borough_feed"]],
+    geometry=shapely.points(stop_lon[has_coords], stop_lat[has_coords]),
+    crs="EPSG:4326"
 )
 
 
-# Merge shapes with routes geodataframe 
-routes_gdf = gpd.GeoDataFrame(lines, geometry="geometry", crs="EPSG:4326")
-routes_gdf = (
-    routes_gdf
-    .merge(
-        shape2route[["shape_uid", "route_id", "route_short_name", "route_long_name", "route_color", "borough_feed"]],
-        on="shape_uid", how="left"
+if DRAW_ROUTES:
+    shapes = tables["shapes.txt"]
+    routes = tables["routes.txt"]
+    trips  = tables["trips.txt"]
+
+    # Mapping for shapes and route labels (short/long name)
+    # join keys become categoricals sharing one dtype per column, so the merge
+    # hashes integer codes instead of strings
+    key_dtypes = {
+        "route_id": pd.CategoricalDtype(pd.concat([trips["route_id"], routes["route_id"]]).dropna().unique()),
+        "borough_feed": pd.CategoricalDtype([zp.stem for zp in zip_paths]),
+    }
+    shape_id_dtype = pd.CategoricalDtype(shapes["shape_id"].unique())
+
+    # make a collision-proof shape key (shape_id can repeat across feeds):
+    # feed code in the high 32 bits, shape_id code in the low 32 bits
+    # (shape_ids that have no points in shapes.txt all get -1)
+    def shape_key(df):
+        feed = df["borough_feed"].astype(key_dtypes["borough_feed"]).cat.codes.to_numpy(np.int64)
+        shape = df["shape_id"].astype(shape_id_dtype).cat.codes.to_numpy(np.int64)
+        return (feed << 32) | shape
+
+    shapes["shape_uid"] = shape_key(shapes)
+    trips = trips.astype(key_dtypes)
+    routes = routes.astype(key_dtypes)
+
+    # Merge trips to routes
+    shape2route = (
+        trips[["route_id", "shape_id", "borough_feed"]].dropna()
+        .drop_duplicates(["shape_id", "borough_feed"])
+        .merge(
+            routes[["route_id", "route_short_name", "route_long_name", "route_color", "borough_feed"]],
+            on=["route_id", "borough_feed"], how="left"
+        )
     )
-)
+    shape2route["route_id"] = shape2route["route_id"].astype(object)  # plain labels for styling/tooltips
+    shape2route["shape_uid"] = shape_key(shape2route)
 
-# filter for few specific routes if needed (specially If the map feels slow)
-# routes_gdf = routes_gdf[routes_gdf["route_id"].isin(["Q43","Q1","Q17","Q83"])]
+    # build LineStrings per shapes (shape_uid)
+    # (points are sorted so each shape is one contiguous run; shapely then builds
+    # every line in a single call using the run's group code as its index)
+    shapes_sorted = shapes.sort_values(["shape_uid", "shape_pt_sequence"])
+    coords = np.column_stack([
+        shapes_sorted["shape_pt_lon"].to_numpy(),
+        shapes_sorted["shape_pt_lat"].to_numpy(),
+    ])
+    codes, shape_uids = pd.factorize(shapes_sorted["shape_uid"], sort=False)
+
+    # a route often carries exactly the same polyline under several shape_ids
+    # (service variants); draw each (route_id, polyline) pair once, under the
+    # first of its shape_uids
+    offsets = np.concatenate([[0], np.flatnonzero(np.diff(codes)) + 1, [len(codes)]])
+    shape_digests = pd.DataFrame({
+        "shape_uid": shape_uids,
+        "digest": [hashlib.blake2b(coords[a:b].tobytes(), digest_size=16).digest()
+                   for a, b in zip(offsets[:-1], offsets[1:])],
+    })
+    shape_digests["route_id"] = shape_digests["shape_uid"].map(
+        shape2route.set_index("shape_uid")["route_id"]
+    )
+    keep = ~shape_digests.duplicated(["route_id", "digest"]).to_numpy()
+    run_lengths = np.diff(offsets)[keep]
+    coords = coords[np.repeat(keep, np.diff(offsets))]
+    codes = np.repeat(np.arange(len(run_lengths)), run_lengths)
+    shape_uids = shape_uids[keep]
+    shape2route = shape2route[shape2route["shape_uid"].isin(shape_uids)]
+
+    # lines are simplified (~1 m tolerance, invisible at city zoom levels) and
+    # coordinates rounded to 6 decimals (Leaflet's precision) so the GeoJSON
+    # written into the page stays small
+    geoms = shapely.linestrings(coords, indices=codes)
+    geoms = shapely.simplify(geoms, tolerance=1e-5, preserve_topology=False)
+    lines = pd.DataFrame({
+        "shape_uid": shape_uids,
+        "geometry": shapely.transform(geoms, lambda c: c.round(6)),
+    })
+
+
+    # Merge shapes with routes geodataframe 
+    routes_gdf = gpd.GeoDataFrame(lines, geometry="geometry", crs="EPSG:4326")
+    routes_gdf = (
+        routes_gdf
+        .merge(
+            shape2route[["shape_uid", "route_id", "route_short_name", "route_long_name", "route_color", "borough_feed"]],
+            on="shape_uid", how="left"
+        )
+    )
+
+    # filter for few specific routes if needed (specially If the map feels slow)
+    # routes_gdf = routes_gdf[routes_gdf["route_id"].isin(["Q43","Q1","Q17","Q83"])]
+
+    # one spatial index over the stops answers the distance query for all routes
+    if STOPS_NEAR_ROUTES_ONLY:
+        stop_tree = shapely.STRtree(stops_gdf.geometry.values)
+        _, near = stop_tree.query(routes_gdf.geometry.values, predicate="dwithin", distance=1e-4)
+        stops_gdf = stops_gdf.iloc[np.unique(near)]
 
-# Get stops GeoDataFrame (keep borough_feed to avoid ID ambiguity)
-stops_gdf = gpd.GeoDataFrame(
-    stops[["stop_id", "stop_name", "stop_lat", "stop_lon", "borough_feed"]],
-    geometry=gpd.points_from_xy(stops["stop_lon"], stops["stop_lat"]),
-    crs="EPSG:4326"
-)
 
 # Create base folium map
 m = folium.Map(tiles="cartodbpositron", zoom_start=11, prefer_canvas=True)
 
-# Fit to route bounds
-minx, miny, maxx, maxy = routes_gdf.total_bounds
-m.fit_bounds([[miny, minx], [maxy, maxx]])
+# Fit to route bounds (stop bounds for a stops-only map), taken straight from
+# the lon/lat arrays instead of the geometries; only the points of shapes
+# still in routes_gdf count, so the route filter above also sets the view
+# (falls back to the stops if the filters left no routes, and keeps the
+# default view if nothing is left at all)
+bound_coords = stops_gdf[["stop_lon", "stop_lat"]].to_numpy()
+if DRAW_ROUTES:
+    route_coords = coords[np.isin(shape_uids, routes_gdf["shape_uid"].to_numpy())[codes]]
+    if len(route_coords):
+        bound_coords = route_coords
+if len(bound_coords):
+    minx, miny = bound_coords.min(axis=0).tolist()
+    maxx, maxy = bound_coords.max(axis=0).tolist()
+    m.fit_bounds([[miny, minx], [maxy, maxx]])
 
 # Create explicit panes so stops are ABOVE routes
 folium.map.CustomPane("routes", z_index=400).add_to(m)
 folium.map.CustomPane("stops",  z_index=650).add_to(m)
 
 
-# draw each shape (LineString) as a polyline
-def line_to_latlon_coords(geom):
-    # geom is a shapely LineString or MultiLineString
-    if geom.geom_type == "LineString":
-        return [(lat, lon) for lon, lat in geom.coords]
-    elif geom.geom_type == "MultiLineString":
-        coords = []
-        for part in geom.geoms:
-            coords.extend([(lat, lon) for lon, lat in part.coords])
-        return coords
-    else:
-        return []
-
-# color by route (simple cycle)
-# Challenge: Use route_color from routes_gdf
-palette = [
-    "red","blue","green","purple","orange","darkred","lightred","mediumgreen",
-    "darkblue","darkgreen","cadetblue","darkpurple","brown","pink","lightblue",
-    "lightgreen","gray","navy","lightgray", "maroon", "mediumyellow"
-]
-color_map = {}
-
-# Tooltip fields if present
-tooltip_fields = [f for f in ["route_id","route_long_name"] if f in routes_gdf.columns]
-
-for i, row in routes_gdf.iterrows():
-    route = row.get("route_id") or row.get("route_short_name") or "route"
-    if route not in color_map:
-        color_map[route] = palette[len(color_map) % len(palette)]
-    coords = line_to_latlon_coords(row.geometry)
-    if coords:
-        folium.PolyLine(
-            locations=coords,
-            color=color_map[route],
-            weight=4,
-            opacity=0.9,
-            tooltip=f"Route ID: {route}",
-        ).add_to(m)
+if DRAW_ROUTES and len(routes_gdf):
+    # draw all shapes (LineStrings) as one GeoJSON layer
+    # (skipped if the route filter left nothing: an empty layer fails its tooltip check)
+    # color by route (simple cycle)
+    # Challenge: Use route_color from routes_gdf
+    palette = [
+        "red","blue","green","purple","orange","darkred","lightred","mediumgreen",
+        "darkblue","darkgreen","cadetblue","darkpurple","brown","pink","lightblue",
+        "lightgreen","gray","navy","lightgray", "maroon", "mediumyellow"
+    ]
+    route_labels = routes_gdf["route_id"].fillna(routes_gdf["route_short_name"]).fillna("route")
+    uniq = route_labels.unique()  # in order of first appearance
+    color_map = dict(zip(uniq, [palette[i % len(palette)] for i in range(len(uniq))]))
+    routes_gdf["_color"] = route_labels.map(color_map)
+
+    # Tooltip fields if present
+    tooltip_fields = [f for f in ["route_id","route_long_name"] if f in routes_gdf.columns]
+
+    folium.GeoJson(
+        routes_gdf[tooltip_fields + ["_color", "geometry"]].to_json(),
+        name="Routes",
+        style_function=lambda f: {"color": f["properties"]["_color"], "weight": 4, "opacity": 0.9},
+        tooltip=folium.GeoJsonTooltip(fields=tooltip_fields),
+    ).add_to(m)
 
 
 # Add stops as dots
-stops_raw = folium.FeatureGroup(name="Stops (dots)", show=True)
-for _, s in stops_gdf.iterrows():
-    folium.CircleMarker(
-        location=[s["stop_lat"], s["stop_lon"]],
-        radius=2,
-        color="#111",
-        fill=True,
-        fill_opacity=0.8,
-        opacity=0.8,
-        tooltip=f"{s.get('stop_name','')} (ID: {s.get('stop_id','')})"
-    ).add_to(stops_raw)
+# all stops go into the page as one JSON array and the browser creates the
+# markers in a loop, instead of templating one CircleMarker per stop
+class StopDots(MacroElement):
+    # rows are [lat, lon, name, id]; markers are added in bulk to the parent cluster
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        var {{ this.get_name() }} = {{ this.data }};
+        {{ this._parent.get_name() }}.addLayers({{ this.get_name() }}.map(function (r) {
+            return L.circleMarker([r[0], r[1]], {
+                radius: 2, color: "#111", fill: true, fillOpacity: 0.8, opacity: 0.8
+            }).bindTooltip(r[2] + " (ID: " + r[3] + ")");
+        }));
+        {% endmacro %}
+    """)
 
+    def __init__(self, rows):
+        super().__init__()
+        self._name = "StopDots"
+        self.data = json.dumps(rows, separators=(",", ":"))
+
+
+stops_data = (
+    stops_gdf[["stop_lat", "stop_lon", "stop_name", "stop_id"]]
+    .astype({"stop_lat": "float64", "stop_lon": "float64"})
+    .round(6)
+    .values.tolist()
+)
+# clustered below zoom 15 so the browser only draws the visible clusters
+stops_raw = MarkerCluster(
+    name="Stops (dots)", show=True,
+    disable_clustering_at_zoom=15, chunked_loading=True,
+)
+StopDots(stops_data).add_to(stops_raw)
 stops_raw.add_to(m)
 folium.LayerControl(collapsed=False).add_to(m)
 
 # Open map on the web
+# (render once and also write a gzipped copy, which is much smaller to
+# store or serve with Content-Encoding: gzip)
 out = Path("mta_bus_map.html").resolve()
-m.save(str(out))
-print(f"Wrote {out}")
+html = m.get_root().render()
+out.write_text(html, encoding="utf-8")
+with gzip.open(out.with_name(out.name + ".gz"), "wt", encoding="utf-8") as f:
+    f.write(html)
+print(f"Wrote {out} (+ .gz)")
 webbrowser.open(out.as_uri(), new=2)